@@ -4,6 +4,9 @@ import datetime
 import string
 import os
 
+_RANDOM_BYTE_TO_LETTER = bytes(ord(string.ascii_lowercase[i % len(string.ascii_lowercase)]) for i in range(256))
+# maps a random byte to a lowercase letter, used with bytes.translate to turn random bytes into dummy content
+
 
 class AliceLib:
     """
@@ -31,13 +34,15 @@ class AliceLib:
         if not os.path.exists(local_output_file):
             local_file_dir = os.path.split(local_output_file)[0]
             os.makedirs(local_file_dir, exist_ok=True)
+            severities = list(logging._nameToLevel.keys())
+            lines = []
+            for _ in range(AliceLib.line):
+                timestamp += datetime.timedelta(seconds=random.randint(1, 30))
+                datetime_string = timestamp.strftime("%Y-%m-%d %H:%M:%S")
+                # draw all the letters of a line at once, rather than calling random.choice for each of them
+                letters = random.randbytes(1000).translate(_RANDOM_BYTE_TO_LETTER).decode()
+                dummy_content = ' '.join(letters[i:i + 100] for i in range(0, 1000, 100))
+                lines.append(f"[{datetime_string}][{random.choice(severities)}] {dummy_content}\n")
             with open(AliceLib.local_temp_dir + remote_file, 'w') as f:
-                for _ in range(AliceLib.line):
-                    timestamp += datetime.timedelta(seconds=random.randint(1, 30))
-                    datetime_string = timestamp.strftime("%Y-%m-%d %H:%M:%S")
-                    letters = string.ascii_lowercase
-                    dummy_content = ' '.join(
-                        [(''.join(random.choice(letters) for i in range(100))) for j in range(10)])
-                    f.write(
-                        f"[{datetime_string}][{random.choice(list(logging._nameToLevel.keys()))}] {dummy_content}\n")
+                f.write(''.join(lines))
         return local_output_file
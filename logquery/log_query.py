@@ -1,12 +1,31 @@
+import array
+import bisect
+import calendar
 import datetime
 import functools
 import heapq
+import itertools
 import logging
-from sortedcontainers import SortedList
-import re
-import linecache
+import mmap
+import operator
+import os
+import struct
+import sys
 from logquery.alice_lib import AliceLib
 
+_SEVERITY_LEVELS = {name.encode(): level for name, level in logging._nameToLevel.items()}
+# severity names as written in the log files, e.g. b"WARNING", mapped to their logging levels
+
+_INDEX_FILE_SUFFIX = ".idx"
+_INDEX_FILE_MAGIC = b"LQIX"
+_INDEX_FILE_VERSION = 3
+_INDEX_FILE_HEADER = struct.Struct("<4sIqqQI")
+_INDEX_FILE_SEVERITY = struct.Struct("<qQ")
+# the index of a log file is saved next to it, e.g. server1.log.idx, and reused as long as the log file is unchanged.
+# The layout is a header (magic, version, log mtime in ns, log size, line count, severity count), then a
+# (severity, line count) pair per severity, then little endian int64 columns: the line offsets and header ends of the
+# log, followed by the epochs and line numbers of each severity in the same order as the pairs
+
 
 class LogQuery:
 
@@ -19,85 +38,266 @@ class LogQuery:
         self._server_to_remote_file = kwargs
         self._server_to_local_file = {}
 
-        self._server_index: dict[str, SortedList[int, int]] = dict()
-        # server index to quickly locate which lines belong to a server. It can support quick search on timestamp
-        # leveraging the sorting feature of SortedList
-        # dict[server name, SortedList[(epoch, line_number) ]]
-
-        self._severity_index: dict[int, SortedList[(int, str, int)]] = dict()
-        # severity index to quickly locate which lines belong to a severity. It can support quick search on timestamp
-        # leveraging the sorting feature of SortedList
-        # dict[severity, SortedList[(epoch, file_name, line_number) ]]
+        self._server_index: dict[str, dict[int, tuple[array.array, array.array]]] = dict()
+        # server index to quickly locate which lines of a server have a given severity. The lines are sorted once
+        # after the log file is read and never change afterwards, so it can support quick search on timestamp with
+        # bisect, and lines below the requested severity are never visited during a search. The lines are kept as two
+        # parallel arrays rather than a list of tuples, which takes 16 bytes per line instead of a tuple object each
+        # dict[server name, dict[severity, (array[epoch], array[line_number]) ]]
+
+        self._server_to_log_buffer: dict[str, mmap.mmap] = dict()
+        self._server_to_line_offsets: dict[str, array.array] = dict()
+        self._server_to_header_ends: dict[str, array.array] = dict()
+        self._server_to_log_stat: dict[str, tuple[int, int]] = dict()
+        # the log file of each server stays mapped after indexing, together with the byte offset of every line and
+        # of the end of its "[timestamp][severity]" header, so a result line is read with a single slice and the
+        # server name is inserted without parsing the line again
+        # dict[server name, array[offset of line_number - 1]], and (mtime in ns, size) of the mapped content
+
+        self._cached_render_line = functools.lru_cache(maxsize=4096)(
+            functools.partial(self._render_line, self._server_to_log_buffer,
+                              self._server_to_line_offsets, self._server_to_header_ends))
+        # rendered result lines, keyed by (server, line_number). Subsequent queries often return overlapping lines.
+        # The cache is per instance and only refers to the dicts it reads, not to the instance, so it does not create
+        # a reference cycle that would keep the instance and its mapped log files alive until the garbage collector
+        # runs
+
+    def close(self):
+        """
+        Release the mapped log files. If the instance is queried again, the logs are lazily indexed again.
+        """
+        self._cached_render_line.cache_clear()
+        for buf in self._server_to_log_buffer.values():
+            buf.close()
+        self._server_to_local_file.clear()
+        self._server_index.clear()
+        self._server_to_log_buffer.clear()
+        self._server_to_line_offsets.clear()
+        self._server_to_header_ends.clear()
+        self._server_to_log_stat.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     @staticmethod
     def _to_epoch_seconds(dt: datetime):
         return int((dt - datetime.datetime(1970, 1, 1)).total_seconds())
 
     @staticmethod
-    def _parse_line(line):
-
-        m = re.match(r'\[(.*)\]\[(.*)\](.*)', line)
-        datetime_string = m.group(1)
-        severity_string = m.group(2)
-        content = m.group(3)
-        return datetime_string, severity_string, content
+    @functools.lru_cache(maxsize=1024)
+    def _date_to_epoch(date_string):
+        # epoch seconds of midnight of a b"%Y-%m-%d" date
+        return calendar.timegm((int(date_string[0:4]), int(date_string[5:7]), int(date_string[8:10]), 0, 0, 0, 0, 0, 0))
 
     @staticmethod
-    def _get_line_metadata(line):
+    def _scan_log(buf):
+        """
+        Parse every line of a log file buffer, without decoding it. This is the hot loop of indexing, so it only
+        touches locals and parses the fixed layout of a log line inline.
 
-        datetime_string, severity_string, _ = LogQuery._parse_line(line)
-        severity = getattr(logging, severity_string.upper())
-        dt = datetime.datetime.strptime(datetime_string, "%Y-%m-%d %H:%M:%S")
-        epoch_seconds = LogQuery._to_epoch_seconds(dt)
-        return epoch_seconds, severity
+        :param buf: the content of the log file, bytes or a mmap
+        :return: (severity index, line offsets, header ends), the severity index being
+            dict[severity, list[(epoch, line_number) ]] in file order, not sorted yet
+        """
+        severity_index = dict()
+        line_offsets = array.array('q')
+        header_ends = array.array('q')
+        append_line_offset = line_offsets.append
+        append_header_end = header_ends.append
+        severity_levels = _SEVERITY_LEVELS
+        date_to_epoch = LogQuery._date_to_epoch
+        find = buf.find
+        size = len(buf)
+        line_number = 1
+        pos = 0
+        while pos < size:
+            end = find(b'\n', pos)
+            if end < 0:
+                end = size
+            # a log line is laid out as "[YYYY-mm-dd HH:MM:SS][SEVERITY] content", so the timestamp always takes the
+            # 19 bytes after the first bracket and the severity starts right after the second one
+            header_end = find(b']', pos + 22) + 1
+            severity = severity_levels[buf[pos + 22:header_end - 1]]
+            # converting the timestamp fields directly is much cheaper than going through strptime. Consecutive lines
+            # nearly always share the date, so only the time of day is computed per line
+            epoch = (date_to_epoch(buf[pos + 1:pos + 11]) + int(buf[pos + 12:pos + 14]) * 3600
+                     + int(buf[pos + 15:pos + 17]) * 60 + int(buf[pos + 18:pos + 20]))
+            lines = severity_index.get(severity)
+            if lines is None:
+                lines = severity_index[severity] = []
+            lines.append((epoch, line_number))
+            append_line_offset(pos)
+            append_header_end(header_end)
+            line_number += 1
+            pos = end + 1
+        return severity_index, line_offsets, header_ends
+
+    def _map_log_file(self, server, f, stat):
+        """
+        Map the log file opened as f, stat being os.fstat of f. The stat, kept as the stamp of a saved index, and the
+        mapping come from the same descriptor, and exactly stat.st_size bytes are mapped, so a saved index is only
+        reused for the content it was built from, even if the log is appended to while it is being indexed.
+        """
+        self._server_to_log_stat[server] = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size == 0:
+            # an empty file cannot be mapped, and there is nothing to index or read anyway
+            return None
+        buf = mmap.mmap(f.fileno(), stat.st_size, access=mmap.ACCESS_READ)
+        self._server_to_log_buffer[server] = buf
+        return buf
 
-    def _add_to_server_index(self, epoch, server, line_number):
-        self._server_index[server].add((epoch, line_number))
+    def _add_to_index(self, server, file_name):
+        with open(file_name, 'rb') as f:
+            buf = self._map_log_file(server, f, os.fstat(f.fileno()))
+        if buf is None:
+            severity_index, line_offsets, header_ends = dict(), array.array('q'), array.array('q')
+        else:
+            severity_index, line_offsets, header_ends = self._scan_log(buf)
+        for severity, lines in severity_index.items():
+            lines.sort()
+            severity_index[severity] = (array.array('q', map(operator.itemgetter(0), lines)),
+                                        array.array('q', map(operator.itemgetter(1), lines)))
+        self._server_index[server] = severity_index
+        self._server_to_line_offsets[server] = line_offsets
+        self._server_to_header_ends[server] = header_ends
+
+    def _save_index(self, server, file_name):
+        mtime, size = self._server_to_log_stat[server]
+        line_offsets = self._server_to_line_offsets[server]
+        severity_index = self._server_index[server]
+        header = [_INDEX_FILE_HEADER.pack(_INDEX_FILE_MAGIC, _INDEX_FILE_VERSION, mtime, size,
+                                          len(line_offsets), len(severity_index))]
+        columns = [line_offsets, self._server_to_header_ends[server]]
+        for severity, (epochs, line_numbers) in severity_index.items():
+            header.append(_INDEX_FILE_SEVERITY.pack(severity, len(epochs)))
+            columns += [epochs, line_numbers]
+        index_file = file_name + _INDEX_FILE_SUFFIX
+        try:
+            # write to a temporary file first, so a concurrent reader never sees a partially written index
+            with open(index_file + ".tmp", 'wb') as f:
+                f.write(b''.join(header))
+                for column in columns:
+                    if sys.byteorder == 'big':
+                        column = array.array('q', column)
+                        column.byteswap()
+                    column.tofile(f)
+            os.replace(index_file + ".tmp", index_file)
+        except OSError:
+            # the index file is only a cache, failing to write it means the log is indexed again next time
+            pass
 
-    def _add_to_severity_index(self, epoch, severity, server, line_number):
-        if severity not in self._severity_index:
-            self._severity_index[severity] = SortedList(key=lambda x: x[0])
-        self._severity_index[severity].add((epoch, server, line_number))
+    @staticmethod
+    def _read_index(data, mtime, size):
+        """
+        Parse an index saved by _save_index.
 
-    def _add_to_index(self, server, file_name):
-        if server not in self._server_index:
-            self._server_index[server] = SortedList(key=lambda x: x[0])
-        with open(file_name, 'r') as f:
-            line_number = 1
-            for line in f:
-                epoch, severity = self._get_line_metadata(line)
-                self._add_to_server_index(epoch, server, line_number)
-                self._add_to_severity_index(epoch, severity, server, line_number)
-                line_number += 1
+        :param data: the content of the index file
+        :param mtime: mtime in ns of the log file, the index is only valid if it was saved for the same mtime and size
+        :param size: size of the log file
+        :return: (severity index, line offsets, header ends), or None if the index is stale or malformed
+        """
+        try:
+            magic, version, saved_mtime, saved_size, line_count, severity_count = _INDEX_FILE_HEADER.unpack_from(data)
+            if (magic, version, saved_mtime, saved_size) != (_INDEX_FILE_MAGIC, _INDEX_FILE_VERSION, mtime, size):
+                # the log file changed since the index was saved, or it was saved by another version of LogQuery
+                return None
+            pos = _INDEX_FILE_HEADER.size
+            severity_counts = []
+            for _ in range(severity_count):
+                severity_counts.append(_INDEX_FILE_SEVERITY.unpack_from(data, pos))
+                pos += _INDEX_FILE_SEVERITY.size
+        except struct.error:
+            return None
+        column_counts = [line_count, line_count]
+        for _, count in severity_counts:
+            column_counts += [count, count]
+        if len(data) != pos + 8 * sum(column_counts):
+            return None
+
+        columns = []
+        for count in column_counts:
+            column = array.array('q')
+            column.frombytes(data[pos:pos + 8 * count])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            columns.append(column)
+            pos += 8 * count
+        line_offsets, header_ends = columns[0], columns[1]
+        severity_index = {severity: (columns[2 + 2 * i], columns[3 + 2 * i])
+                          for i, (severity, _) in enumerate(severity_counts)}
+        # a truncated or tampered index must not make query read outside of the log file
+        if any(min(line_numbers) < 1 or max(line_numbers) > line_count
+               for _, line_numbers in severity_index.values() if line_numbers):
+            return None
+        if line_count and (max(line_offsets) >= size or max(header_ends) > size):
+            return None
+        return severity_index, line_offsets, header_ends
+
+    def _load_index(self, server, file_name):
+        """
+        Load the index saved by _save_index for this log file, if it is still up to date. The log file is only
+        mapped once the index is known to be valid, otherwise _add_to_index maps it.
+
+        :return: True if the index was loaded, False if the log file has to be indexed
+        """
+        try:
+            with open(file_name + _INDEX_FILE_SUFFIX, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return False
+        with open(file_name, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            index = self._read_index(data, stat.st_mtime_ns, stat.st_size)
+            if index is None:
+                return False
+            self._map_log_file(server, f, stat)
+        self._server_index[server], self._server_to_line_offsets[server], self._server_to_header_ends[server] = index
+        return True
 
     def _add_server_log_to_index(self, server):
         file_name = AliceLib.get_remote_file(server, self._server_to_remote_file[server])
-        self._server_index[server] = SortedList(key=lambda x: x[0])
-        self._add_to_index(server, file_name)
+        if not self._load_index(server, file_name):
+            self._add_to_index(server, file_name)
+            self._save_index(server, file_name)
         self._server_to_local_file[server] = file_name
 
+    @staticmethod
+    def _render_line(server_to_log_buffer, server_to_line_offsets, server_to_header_ends, server, line_number):
+        buf = server_to_log_buffer[server]
+        start = server_to_line_offsets[server][line_number - 1]
+        header_end = server_to_header_ends[server][line_number - 1]
+        end = buf.find(b'\n', start)
+        if end < 0:
+            end = len(buf)
+        if end > start and buf[end - 1] == ord('\r'):
+            # a CRLF line ending, e.g. a log written in text mode on Windows
+            end -= 1
+        raw_log_line = buf[start:end].decode()
+        # the header is ASCII, so its length in bytes is also its length in characters
+        header_length = header_end - start
+        return f"{raw_log_line[:header_length]}[{server}]{raw_log_line[header_length:]}"
+
     def search(self, servers, min_severity, start_epoch, entries):
         """
-        This function first locate the first line in each server log that has a timestamp greater
-        than or equal to the user specified start time. Then it leverage a heap to process line by line,
-        ordered by timestamp, from ALL the server log. For each line indexed, this function looks up in the severity
-        index to check if it meet the severity requirement, it only adds the line,
-        represented by (timestamp, server, line_number) to the result list.
+        This function first locate, for each server and each severity at or above the user specified severity,
+        the first line that has a timestamp greater than or equal to the user specified start time. Then it leverage
+        heapq.merge to process line by line, ordered by timestamp, from ALL these sorted lists. Every line visited
+        meets the severity requirement already, so it is added to the result list,
+        represented by (timestamp, server, line_number).
 
         Assuming that there are n servers, m entries in each server on average and a samll number of w severity levels.
 
-        Locating the first line in each server will be O(logm), since we are using a sorted list to store all the lines,
-        so we can take advantage of binary search.
-
-        For each line, we need pop it from the heap, costing O(1), checking if it exists in proper severity indexes,
-        costing O(log(nm/w)), then add the next line to heap, costing O(logn).
-
-        Assuming a factor sparsity = (# of all the logs) / (# of log entries worse than min_severity)
+        Locating the first line in each list will be O(logm), since all the lines are kept sorted by timestamp,
+        so we can take advantage of binary search, and the stream then starts from that line without walking the
+        lines before it, costing O(n * w * logm) in total.
 
-        we need to process O(entries * sparsity * (1 + log(n) + w * log(nm/w))). If we assume m > n, then it can be
-        simplified as O( entries * sparsity * log(m)).
+        For each line, heapq.merge pops it from the heap and pushes the next line of the same list, costing
+        O(log(nw)).
 
-        Worst case scenario, entries * sparsity = all the log lines indexed = n * m.
+        Lines below min_severity are never visited, so we need to process O(n * w * logm + entries * log(nw)).
 
 
         :param servers: query parameter specified by the user
@@ -107,32 +307,28 @@ class LogQuery:
         :return: the first #entries log indexes, (server, line_number) to get the raw log entry, sorted by timestamp
 
         """
-        heap = []
-        heapq.heapify(heap)
-        result = []
-        # add the first line from each server log that has a timestamp later than start_epoch and add to a heap
+        return list(itertools.islice(self._search_iter(servers, min_severity, start_epoch), entries))
+
+    def _search_iter(self, servers, min_severity, start_epoch):
+        """
+        Lazy version of search: all the matching lines, represented by (timestamp, server, line_number), sorted by
+        timestamp. Lines are only merged as the caller consumes them, so a caller that stops early does no extra work.
+        """
+        iterables = []
+        server_index = self._server_index
+        # a stream of lines, sorted by timestamp, for each (server, severity) that meets the severity requirement
         for server in servers:
-            idx = self._server_index[server].bisect_left((start_epoch, 0))
-            timestamp, line_number = self._server_index[server][idx]
-            heapq.heappush(heap, (timestamp, server, line_number, idx))
-
-        while heap:
-            curr_timestamp, server, curr_line_number, curr_idx = heapq.heappop(heap)
-            # we always pop the line with the smallest timestamp from all the servers
-            for severity in self._severity_index:
-                if severity >= min_severity \
-                        and (curr_timestamp, server, curr_line_number) in self._severity_index[severity]:
-                    result.append((curr_timestamp, server, curr_line_number))
-                    # only add to result list if it meets severity criterion too
-                    if len(result) >= entries:
-                        return result
-            next_idx = curr_idx + 1
-            if next_idx < len(self._server_index[server]):
-                next_timestamp, next_line_number = self._server_index[server][next_idx]
-                heapq.heappush(heap, (next_timestamp, server, next_line_number, next_idx))
-                # add the next line in the server log to the heap
-
-        return result
+            for severity, (epochs, line_numbers) in server_index[server].items():
+                if severity >= min_severity:
+                    idx = bisect.bisect_left(epochs, start_epoch)
+                    # slicing a memoryview starts at idx in O(1), where itertools.islice would step over the first
+                    # idx elements one by one
+                    iterables.append(zip(memoryview(epochs)[idx:],
+                                         itertools.repeat(server),
+                                         memoryview(line_numbers)[idx:]))
+
+        # we always take the line with the smallest timestamp from all the streams
+        return heapq.merge(*iterables)
 
     @staticmethod
     def _search_results_intersection(*matched_lines, entries):
@@ -140,19 +336,29 @@ class LogQuery:
 
         final_result_set = functools.reduce(lambda a, b: a.intersection(b), matched_lines_set)
 
-        return SortedList(final_result_set, key=lambda x: x[0])[:entries]
+        return sorted(final_result_set)[:entries]
 
     def query(self, start: datetime.datetime, entries: int, servers: list[str], min_severity: int):
+        """
+        Yield the first #entries log lines of the given servers, at or after start and at or above min_severity,
+        sorted by timestamp.
+
+        Each line is the raw log line with the server name inserted after its header:
+        "[YYYY-mm-dd HH:MM:SS][SEVERITY][server] content", with a single space before the content. Versions before
+        the slicing line parser yielded two spaces there, because the separator was kept as part of the content.
+
+        :param start: only lines with a timestamp greater than or equal to start are returned
+        :param entries: the maximum number of lines to return
+        :param servers: the servers to search, as named in the constructor
+        :param min_severity: a logging level, e.g. logging.WARN
+        """
         for server in servers:
             # lazily index a log file
             if server not in self._server_to_local_file:
                 self._add_server_log_to_index(server)
 
         start_epoch = self._to_epoch_seconds(start)
-        matched_lines = self.search(servers, min_severity, start_epoch, entries)
-        result_lines = matched_lines
-        for timestamp, server, line_number in result_lines:
-            file_name = self._server_to_local_file[server]
-            raw_log_line = linecache.getline(file_name, line_number)
-            datetime_string, severity_string, content = self._parse_line(raw_log_line)
-            yield f"[{datetime_string}][{severity_string}][{server}] {content}"
+        matched_lines = self._search_iter(servers, min_severity, start_epoch)
+        render_line = self._cached_render_line
+        for timestamp, server, line_number in itertools.islice(matched_lines, entries):
+            yield render_line(server, line_number)
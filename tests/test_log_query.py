@@ -1,14 +1,18 @@
+import gc
 import logging
 import os
 import re
 import unittest
 import shutil
+import weakref
 from datetime import datetime
 from unittest import mock
 from logquery import alice_lib
 from logquery.alice_lib import AliceLib
 from logquery.log_query import LogQuery
 
+_RESULT_LINE_RE = re.compile(r'\[([^\]]*)\]\[([^\]]*)\]\[([^\]]*)\](.*)')
+
 
 class TestLogQuery(unittest.TestCase):
 
@@ -19,7 +23,7 @@ class TestLogQuery(unittest.TestCase):
 
     def _parse_result_line(self, line):
 
-        m = re.match(r'\[(.*)\]\[(.*)\]\[(.*)\](.*)', line)
+        m = _RESULT_LINE_RE.match(line)
         datetime_str = m.group(1)
         severity_str = m.group(2)
         server_str = m.group(3)
@@ -148,6 +152,119 @@ class TestLogQuery(unittest.TestCase):
 
             monkey.assert_called_once_with("db_server", "lazy_download/temp.log")
 
+    def test_saved_index(self):
+        entries = 50
+        start = datetime(2021, 1, 17, 15)
+        servers = ["server1", "db_server"]
+        log_query = LogQuery(server1="saved_index/server1.log",
+                             db_server="saved_index/temp.log")
+        expected = list(log_query.query(servers=servers,
+                                        min_severity=logging.WARN,
+                                        start=start,
+                                        entries=entries))
+
+        log_query = LogQuery(server1="saved_index/server1.log",
+                             db_server="saved_index/temp.log")
+        with mock.patch.object(log_query, '_add_to_index',
+                               wraps=log_query._add_to_index) as monkey:
+            result = list(log_query.query(servers=servers,
+                                          min_severity=logging.WARN,
+                                          start=start,
+                                          entries=entries))
+            monkey.assert_not_called()
+        self.assertEqual(expected, result, "query returned different entries from a saved index.")
+
+    def test_saved_index_invalidated(self):
+        start = datetime(2021, 1, 17, 15)
+        log_query = LogQuery(server1="saved_index/server1.log")
+        list(log_query.query(servers=["server1"], min_severity=logging.WARN, start=start, entries=50))
+
+        log_file = AliceLib.local_temp_dir + "saved_index/server1.log"
+        with open(log_file, 'a') as f:
+            f.write("[2100-01-01 00:00:00][CRITICAL] appended\n")
+
+        log_query = LogQuery(server1="saved_index/server1.log")
+        with mock.patch.object(log_query, '_add_to_index',
+                               wraps=log_query._add_to_index) as monkey, \
+                mock.patch.object(log_query, '_map_log_file',
+                                  wraps=log_query._map_log_file) as map_monkey:
+            result = list(log_query.query(servers=["server1"],
+                                          min_severity=logging.CRITICAL,
+                                          start=datetime(2100, 1, 1),
+                                          entries=50))
+            monkey.assert_called_once_with("server1", log_file)
+            # a stale index is detected before the log is mapped, so the log is mapped only once, for indexing
+            map_monkey.assert_called_once()
+        self.assertEqual(["[2100-01-01 00:00:00][CRITICAL][server1] appended"], result)
+
+    def test_saved_index_appended_while_indexing(self):
+        log_file = AliceLib.local_temp_dir + "saved_index/server1.log"
+        log_query = LogQuery(server1="saved_index/server1.log")
+
+        def append_then_scan(buf):
+            # the line lands after the log was mapped, so this index does not cover it
+            with open(log_file, 'a') as f:
+                f.write("[2100-01-01 00:00:00][CRITICAL] appended\n")
+            return LogQuery._scan_log(buf)
+
+        with mock.patch.object(log_query, '_scan_log', side_effect=append_then_scan):
+            list(log_query.query(servers=["server1"], min_severity=logging.WARN,
+                                 start=datetime(2021, 1, 17, 15), entries=50))
+
+        log_query = LogQuery(server1="saved_index/server1.log")
+        result = list(log_query.query(servers=["server1"],
+                                      min_severity=logging.CRITICAL,
+                                      start=datetime(2100, 1, 1),
+                                      entries=50))
+        self.assertEqual(["[2100-01-01 00:00:00][CRITICAL][server1] appended"], result,
+                         "a saved index that does not cover the appended line was reused.")
+
+    def test_close(self):
+        start = datetime(2021, 1, 17, 15)
+        with LogQuery(server1="close_test/server1.log") as log_query:
+            expected = list(log_query.query(servers=["server1"], min_severity=logging.WARN, start=start, entries=50))
+            buffer = log_query._server_to_log_buffer["server1"]
+        self.assertTrue(buffer.closed, "close did not release the mapped log file.")
+
+        # a closed instance indexes the log again when it is queried
+        result = list(log_query.query(servers=["server1"], min_severity=logging.WARN, start=start, entries=50))
+        self.assertEqual(expected, result)
+        log_query.close()
+
+    def test_released_without_garbage_collection(self):
+        log_query = LogQuery(server1="close_test/server1.log")
+        list(log_query.query(servers=["server1"], min_severity=logging.WARN,
+                             start=datetime(2021, 1, 17, 15), entries=50))
+        ref = weakref.ref(log_query)
+        gc.disable()
+        try:
+            del log_query
+            self.assertIsNone(ref(), "an unreferenced LogQuery was kept alive by a reference cycle.")
+        finally:
+            gc.enable()
+
+    def test_rendered_line(self):
+        log_file = AliceLib.local_temp_dir + "render_test/server1.log"
+        os.makedirs(os.path.dirname(log_file))
+        with open(log_file, 'wb') as f:
+            # written in binary mode so the line endings are the same on every platform, the last line uses CRLF
+            f.write("[2021-01-17 15:00:00][ERROR] café naïve ☃ content\n".encode())
+            f.write("[2021-01-17 15:00:10][DEBUG] skipped\n".encode())
+            f.write("[2021-01-17 15:00:20][CRITICAL] Zürich ] after bracket\n".encode())
+            f.write("[2021-01-17 15:00:30][WARNING] crlf line\r\n".encode())
+
+        log_query = LogQuery(server1="render_test/server1.log")
+        result = list(log_query.query(servers=["server1"],
+                                      min_severity=logging.WARN,
+                                      start=datetime(2021, 1, 17, 15),
+                                      entries=50))
+
+        # a single space separates the server from the content
+        self.assertEqual(["[2021-01-17 15:00:00][ERROR][server1] café naïve ☃ content",
+                          "[2021-01-17 15:00:20][CRITICAL][server1] Zürich ] after bracket",
+                          "[2021-01-17 15:00:30][WARNING][server1] crlf line"],
+                         result)
+
 
 if __name__ == '__main__':
     unittest.main()